@@ -1,76 +1,305 @@
 import os
 import cv2
+import mmap
+import errno
 
+import queue
 import zipfile
+import threading
+import multiprocessing
 import requests
 import argparse
 import logging
+import functools
 
 import numpy as np
-from shutil import copy2
-from collections import defaultdict
+from bisect import bisect_left
+from itertools import chain
+from concurrent.futures import ThreadPoolExecutor
+from collections import defaultdict, deque
+
+logger = logging.getLogger(__name__)
+
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+# Errors raised when a kernel copy call is unsupported for the given files
+_COPY_FALLBACK_ERRNOS = {errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.EOPNOTSUPP}
+_COPY_CHUNK_SIZE = 1 << 30
+_COPY_BUFFER_SIZE = 1 << 20
+
+# Masks are mostly background, so light zlib compression keeps files small at a fraction of the encode cost
+_PNG_WRITE_PARAMS = [cv2.IMWRITE_PNG_COMPRESSION, 1]
+
+# Decode threads in this process, lowered by _init_worker so pool workers share the cores.
+# Twice as many decodes are kept in flight while streaming masks, which caps how many are held in memory
+_decode_workers = os.cpu_count() or 1
+
+# Decode thread pool shared by every class processed in this process, created on first use
+_decode_executor = None
+
+# Bound on pending mask writes, which caps how many masks are held in memory
+_WRITE_QUEUE_SIZE = 4
+
+# Directory listings keyed by path, stored as (mtime, sorted names, entries)
+_prefix_index_cache = {}
 
 def setup_logging():
     """Setup logging configuration."""
     logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
-def load_mask_images(folder_path):
-    """Load grayscale images from the specified folder based on the base file name."""
-    images = []
-    for filename in os.listdir(folder_path):
-        img = cv2.imread(os.path.join(folder_path, filename), cv2.IMREAD_GRAYSCALE)
-        if img is not None:
-            images.append(img)
-        else:
-            logging.warning(f"Failed to read image: {filename}")
-    return images
-
-def copy_corresponding_files(corresponding_files_dir, output_dir, filename_base):
-    """Copy files that correspond to the mask based on the filename."""
-    for file in os.listdir(corresponding_files_dir):
-        if file.startswith(filename_base):
-            source_file_path = os.path.join(corresponding_files_dir, file)
-            destination_file_path = os.path.join(output_dir, file)
-            copy2(source_file_path, destination_file_path)
-            logging.info(f"Copied corresponding file: {file}")
-
-def combine_masks(mask_images):
-    """Combine multiple mask images into a single image with distinct object IDs."""
-    height, width = mask_images[0].shape
-    combined_mask = np.zeros((height, width), dtype=np.uint16)
-    object_id = 1
-    
+def _get_decode_executor():
+    """Return this process's decode thread pool, creating it on first use."""
+    global _decode_executor
+    if _decode_executor is None:
+        _decode_executor = ThreadPoolExecutor(max_workers=_decode_workers)
+    return _decode_executor
+
+def load_mask_images(file_paths, executor):
+    """Lazily load grayscale images from the given files on the executor, yielding them one at a time."""
+    # OpenCV releases the GIL while decoding, so threads decode in parallel
+    pending = deque()
+    for file_path in file_paths:
+        pending.append((file_path, executor.submit(_read_grayscale, file_path)))
+        if len(pending) >= 2 * _decode_workers:
+            yield from _collect_decoded(*pending.popleft())
+
+    while pending:
+        yield from _collect_decoded(*pending.popleft())
+
+def _read_grayscale(path):
+    """Decode a grayscale image from a memory-mapped file, returning None if it cannot be read."""
+    try:
+        with open(path, 'rb') as f:
+            buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        # Directories and unreadable files cannot be opened, and empty files cannot be mapped
+        return None
+
+    with buffer:
+        return cv2.imdecode(np.frombuffer(buffer, dtype=np.uint8), cv2.IMREAD_GRAYSCALE)
+
+def _collect_decoded(file_path, future):
+    """Yield the image of a pending decode, logging a warning if it could not be read."""
+    img = future.result()
+    if img is None:
+        logger.warning("Failed to read image: %s", os.path.basename(file_path))
+        return
+    yield img
+
+def build_prefix_index(directory_path):
+    """Build a sorted listing of a directory, rescanning only when its mtime changes."""
+    mtime = os.stat(directory_path).st_mtime_ns
+    cached = _prefix_index_cache.get(directory_path)
+    if cached is not None and cached[0] == mtime:
+        return cached
+
+    with os.scandir(directory_path) as it:
+        entries = sorted(it, key=lambda entry: entry.name)
+    index = (mtime, [entry.name for entry in entries], entries)
+    _prefix_index_cache[directory_path] = index
+    return index
+
+def find_corresponding_files(prefix_index, filename_base):
+    """Find files that correspond to the mask based on the filename."""
+    _, names, entries = prefix_index
+    matches = []
+    i = bisect_left(names, filename_base)
+    while i < len(names) and names[i].startswith(filename_base):
+        matches.append(entries[i])
+        i += 1
+    return matches
+
+def _fast_copy(source_file_path, destination_file_path):
+    """Copy file contents in-kernel where possible, falling back to a buffered copy."""
+    with open(source_file_path, 'rb') as source, open(destination_file_path, 'wb') as destination:
+        source_fd, destination_fd = source.fileno(), destination.fileno()
+        offset = 0
+
+        for kernel_copy in (
+            lambda: os.copy_file_range(source_fd, destination_fd, _COPY_CHUNK_SIZE, offset),
+            lambda: os.sendfile(destination_fd, source_fd, offset, _COPY_CHUNK_SIZE),
+        ):
+            try:
+                while True:
+                    copied = kernel_copy()
+                    if copied == 0:
+                        return
+                    offset += copied
+            except AttributeError:
+                continue
+            except OSError as e:
+                if e.errno not in _COPY_FALLBACK_ERRNOS:
+                    raise
+
+        source.seek(offset)
+        destination.seek(offset)
+        while True:
+            buffer = source.read(_COPY_BUFFER_SIZE)
+            if not buffer:
+                return
+            destination.write(buffer)
+
+def copy_matches(matches, output_dir):
+    """Copy previously matched corresponding files into the output directory."""
+    for entry in matches:
+        destination_file_path = os.path.join(output_dir, entry.name)
+        _fast_copy(entry.path, destination_file_path)
+        logger.debug("Copied corresponding file: %s", entry.name)
+
+if njit is not None:
+    @njit(boundscheck=False, cache=True)
+    def _fuse_mask(combined_mask, all_masks, mask, object_id, all_object_id):
+        """Write one mask's object ID into the combined masks in a single pass."""
+        height, width = mask.shape
+        for i in range(height):
+            for j in range(width):
+                if mask[i, j] != 0:
+                    combined_mask[i, j] = object_id
+                    if all_masks is not None:
+                        all_masks[i, j] = all_object_id
+else:
+    _fuse_mask = None
+
+def mask_dtype(n_objects, format="png"):
+    """Pick the smallest integer type that holds n_objects object IDs and can be saved in the given format."""
+    if n_objects <= np.iinfo(np.uint8).max:
+        return np.uint8
+    if n_objects <= np.iinfo(np.uint16).max:
+        return np.uint16
+    # PNG stores at most 16 bits per sample, and OpenCV has no unsigned 32-bit type
+    if format.lower() == "png":
+        raise ValueError(f"{n_objects} objects exceed the 16-bit object IDs a PNG mask can hold, save the masks as tif instead.")
+    return np.int32
+
+def _matching_masks(mask_images, shape):
+    """Yield the masks of the given shape, logging a warning for and skipping any others."""
     for mask in mask_images:
-        indices = np.where(mask > 0)
-        combined_mask[indices] = object_id
-        object_id += 1
-
-    return combined_mask
-
+        if mask.shape != shape:
+            logger.warning("Skipping mask of shape %s, expected %s", mask.shape, shape)
+            continue
+        yield mask
+
+def combine_masks(mask_images, all_masks=None, object_id_offset=0, out=None, dtype=np.uint16):
+    """Combine multiple mask images into a single image with distinct object IDs.
+
+    mask_images may be any iterable; masks are consumed one at a time and not retained.
+    If all_masks is given, each object is also written into it with its ID shifted by object_id_offset.
+    If out is given, it is cleared and used as the combined mask instead of a new array of the given dtype.
+    Returns the combined mask and the number of masks combined.
+    """
+    mask_images = iter(mask_images)
+    first_mask = next(mask_images, None)
+    if first_mask is None:
+        raise ValueError("No mask images to combine.")
+    mask_images = chain([first_mask], mask_images)
+
+    if out is None:
+        combined_mask = np.zeros(first_mask.shape, dtype=dtype)
+    else:
+        combined_mask = out
+        combined_mask.fill(0)
+
+    # The Numba kernel does not bounds check, so every mask must match the output buffers
+    if all_masks is not None and all_masks.shape != combined_mask.shape:
+        raise ValueError(f"all_masks shape {all_masks.shape} does not match combined mask shape {combined_mask.shape}.")
+    mask_images = _matching_masks(mask_images, combined_mask.shape)
+
+    # Later masks take precedence on overlap
+    object_id = 0
+    if _fuse_mask is not None:
+        for object_id, mask in enumerate(mask_images, start=1):
+            _fuse_mask(combined_mask, all_masks, mask, object_id, object_id_offset + object_id)
+        return combined_mask, object_id
+
+    foreground = np.empty(first_mask.shape, dtype=bool)
+    for object_id, mask in enumerate(mask_images, start=1):
+        np.greater(mask, 0, out=foreground)
+        np.putmask(combined_mask, foreground, object_id)
+        if all_masks is not None:
+            np.putmask(all_masks, foreground, object_id_offset + object_id)
+
+    return combined_mask, object_id
+
+def save_mask(save_filepath, mask):
+    """Save a combined mask image, using fast PNG compression where applicable."""
+    params = _PNG_WRITE_PARAMS if save_filepath.lower().endswith(".png") else []
+    if not cv2.imwrite(save_filepath, mask, params):
+        raise OSError(f"Failed to save mask: {save_filepath}")
+    logger.debug("Combined mask image saved as %s", save_filepath)
+
+def _mask_writer(write_queue, free_buffers, errors):
+    """Save masks from the queue until a None sentinel is received, then release their buffers.
+
+    Exceptions are appended to errors so the producer can re-raise them; the queue keeps draining meanwhile.
+    """
+    while True:
+        item = write_queue.get()
+        if item is None:
+            break
+        try:
+            save_mask(*item)
+        except Exception as e:
+            errors.append(e)
+        free_buffers.put(item[1])
+
+def _take_buffer(free_buffers, shape, dtype=np.uint16):
+    """Reuse a mask buffer released by the writer, or allocate one if none fits."""
+    try:
+        buffer = free_buffers.get_nowait()
+    except queue.Empty:
+        return np.empty(shape, dtype=dtype)
+    if buffer.shape != shape or buffer.dtype != dtype:
+        return np.empty(shape, dtype=dtype)
+    return buffer
+
+@functools.lru_cache(maxsize=None)
 def create_directory(directory_path):
-    """Create a directory if it does not exist."""
-    if not os.path.exists(directory_path):
-        os.makedirs(directory_path)
-        logging.info(f"Created directory: {directory_path}")
+    """Create a directory if it does not exist, once per path for the whole run."""
+    os.makedirs(directory_path, exist_ok=True)
+    logger.debug("Directory ready: %s", directory_path)
 
 def split_data(directory_path, val_pattern, test_pattern):
     """Split data into train, validation, and test sets based on specific string patterns."""
     data = defaultdict(list)
 
-    for dirname in os.listdir(directory_path):
-        if val_pattern in dirname:
-            data["valid"].append(os.path.join(directory_path, dirname))
-        elif test_pattern in dirname:
-            data["test"].append(os.path.join(directory_path, dirname))
-        else:
-            data["train"].append(os.path.join(directory_path, dirname))
+    with os.scandir(directory_path) as it:
+        names = np.array([entry.name for entry in it if entry.is_dir(follow_symlinks=False)], dtype=str)
+
+    # Validation matches take precedence over test matches, everything else is training data
+    val_mask = np.char.find(names, val_pattern) >= 0
+    test_mask = ~val_mask & (np.char.find(names, test_pattern) >= 0)
+    train_mask = ~(val_mask | test_mask)
+
+    prefix = os.path.join(directory_path, "")
+    for split_name, split_mask in (("train", train_mask), ("valid", val_mask), ("test", test_mask)):
+        if split_mask.any():
+            data[split_name] = np.char.add(prefix, names[split_mask]).tolist()
 
     return data
 
+def build_mask_tree(dirpaths, exclude_class):
+    """Scan each mask directory once, mapping it to its class names and their mask files."""
+    tree = {}
+    for dirpath in dirpaths:
+        with os.scandir(dirpath) as it:
+            class_entries = [entry for entry in it if entry.is_dir(follow_symlinks=False)]
+
+        tree[dirpath] = {}
+        for class_entry in class_entries:
+            if class_entry.name in exclude_class:
+                logger.info("Skipping %s in %s...", class_entry.name, dirpath)
+                continue
+            with os.scandir(class_entry.path) as it:
+                tree[dirpath][class_entry.name] = [entry.path for entry in it if entry.is_file()]
+    return tree
+
 def process_masks(input_path, image_dirname, mask_dirname, output_dir, val_pattern, test_pattern, format, exclude_class=["Unidentified"]):
     """Process and save combined mask images."""
     if not os.path.exists(input_path):
-        logging.error(f"The input path {input_path} does not exist.")
+        logger.error("The input path %s does not exist.", input_path)
         return
     
     masks_dir = os.path.join(input_path, mask_dirname)
@@ -78,54 +307,128 @@ def process_masks(input_path, image_dirname, mask_dirname, output_dir, val_patte
     
     # Split data into train, validation, and test sets
     data = split_data(masks_dir, val_pattern, test_pattern)
-    
-    # Process and save combined masks for each split
-    for split_name, split_files in data.items():
-
-        for dirpath in split_files:
-
-            filename_base = os.path.basename(dirpath)
-
-            all_masks = []
-            all_masks_output_dir = os.path.join(output_dir, "all", split_name)
-            create_directory(all_masks_output_dir)
-            logging.info(f"Processing {dirpath}...")
-            
-            for class_name in os.listdir(dirpath):
-                
-                if class_name in exclude_class:
-                    logging.info(f"Skipping {class_name}...")
-                    continue
 
-                mask_images = load_mask_images(os.path.join(dirpath, class_name))
-                class_masks = combine_masks(mask_images)
-                all_masks.extend(class_masks)
+    # Index the image directory up front; with the fork start method workers inherit the cached listing,
+    # otherwise each worker builds its own on first use
+    build_prefix_index(images_dir)
 
-                # Create output directory structure: output_dir/class_name/split_name
-                output_dir_class_split = os.path.join(output_dir, class_name, split_name)
-                create_directory(output_dir_class_split)
+    # Each mask directory is independent, so process them in parallel from a single scan of the tree
+    tasks = []
+    for split_name, split_files in data.items():
+        tree = build_mask_tree(split_files, exclude_class)
+        tasks.extend(
+            (split_name, dirpath, class_files, images_dir, output_dir, format)
+            for dirpath, class_files in tree.items()
+        )
+
+    # One worker per core unless there are fewer mask directories, in which case the spare cores decode
+    cpu_count = os.cpu_count() or 1
+    pool_size = max(1, min(cpu_count, len(tasks)))
+    decode_workers = max(1, cpu_count // pool_size)
+    with multiprocessing.Pool(processes=pool_size, initializer=_init_worker, initargs=(decode_workers,)) as pool:
+        pool.starmap(process_one_dirpath, tasks)
+
+def _init_worker(decode_workers):
+    """Set up logging and the number of decode threads in a pool worker."""
+    global _decode_workers
+    _decode_workers = decode_workers
+    setup_logging()
 
-                save_filepath = os.path.join(output_dir_class_split, f"{filename_base}_masks.{format}")
-                cv2.imwrite(save_filepath, class_masks)
-                logging.info(f"Combined mask image saved as {save_filepath}")
+def process_one_dirpath(split_name, dirpath, class_files, images_dir, output_dir, format):
+    """Combine and save the masks of one mask directory."""
+    # Save masks on a background thread so encoding overlaps with loading the next class
+    # Saved masks are handed back through free_buffers so their memory is reused
+    write_queue = queue.Queue(maxsize=_WRITE_QUEUE_SIZE)
+    free_buffers = queue.Queue()
+    errors = []
+    writer = threading.Thread(target=_mask_writer, args=(write_queue, free_buffers, errors), daemon=True)
+    writer.start()
+
+    try:
+        _process_dirpath(split_name, dirpath, class_files, images_dir, output_dir, format, write_queue, free_buffers)
+    finally:
+        write_queue.put(None)
+        writer.join()
+
+    if errors:
+        raise errors[0]
+
+def _process_dirpath(split_name, dirpath, class_files, images_dir, output_dir, format, write_queue, free_buffers):
+    """Combine the masks of one mask directory, queueing them for saving."""
+    filename_base = os.path.basename(dirpath)
+
+    all_masks = None
+    all_masks_dtype = mask_dtype(sum(len(file_paths) for file_paths in class_files.values()), format)
+    object_id_offset = 0
+    all_masks_output_dir = os.path.join(output_dir, "all", split_name)
+    create_directory(all_masks_output_dir)
+    logger.debug("Processing %s...", dirpath)
+
+    # Look up the corresponding files once and reuse them for every class
+    matches = find_corresponding_files(build_prefix_index(images_dir), filename_base)
+
+    n_classes = 0
+    for class_name, file_paths in class_files.items():
+
+        # Peek at the first mask to size the buffers before streaming the rest
+        mask_images = load_mask_images(file_paths, _get_decode_executor())
+        first_mask = next(mask_images, None)
+        if first_mask is None:
+            logger.warning("No mask images found in %s", os.path.join(dirpath, class_name))
+            continue
+
+        if all_masks is None:
+            all_masks = _take_buffer(free_buffers, first_mask.shape, all_masks_dtype)
+            all_masks.fill(0)
+
+        # Classes whose shape differs from the all-classes mask are still saved on their own
+        fold_into_all = first_mask.shape == all_masks.shape
+        if not fold_into_all:
+            logger.warning(
+                "Leaving %s out of the all-classes mask: mask shape %s does not match %s of previous classes",
+                os.path.join(dirpath, class_name), first_mask.shape, all_masks.shape,
+            )
+
+        # Object IDs in the all-classes mask continue from those of previous classes
+        class_masks, n_masks = combine_masks(
+            chain([first_mask], mask_images), all_masks if fold_into_all else None, object_id_offset,
+            out=_take_buffer(free_buffers, first_mask.shape, mask_dtype(len(file_paths), format)),
+        )
+        if fold_into_all:
+            object_id_offset += n_masks
+
+        # Create output directory structure: output_dir/class_name/split_name
+        output_dir_class_split = os.path.join(output_dir, class_name, split_name)
+        create_directory(output_dir_class_split)
+
+        save_filepath = os.path.join(output_dir_class_split, f"{filename_base}_masks.{format}")
+        write_queue.put((save_filepath, class_masks))
+
+        # Copy the corresponding files based on the filename of the mask
+        copy_matches(matches, output_dir_class_split)
+        n_classes += 1
+
+    if all_masks is None:
+        logger.warning("No mask classes found in %s", dirpath)
+        return
 
-                # Copy the corresponding files based on the filename of the mask
-                copy_corresponding_files(images_dir, output_dir_class_split, filename_base)
+    save_filepath = os.path.join(all_masks_output_dir, f"{filename_base}_masks.{format}")
+    write_queue.put((save_filepath, all_masks))
 
-            combined_mask = combine_masks(mask_images)
-            save_filepath = os.path.join(all_masks_output_dir, f"{filename_base}_masks.{format}")
-            cv2.imwrite(save_filepath, combined_mask)
-            logging.info(f"Combined mask image saved as {save_filepath}")
+    # Copy the corresponding files based on the filename of the mask
+    copy_matches(matches, all_masks_output_dir)
 
-            # Copy the corresponding files based on the filename of the mask
-            copy_corresponding_files(images_dir, all_masks_output_dir, filename_base)
+    logger.info(
+        "Combined %d masks from %d classes and copied %d files for %s",
+        object_id_offset, n_classes, (n_classes + 1) * len(matches), filename_base,
+    )
 
 def download_and_unzip(url, directory_path):
     # Check if directory exists
     if not os.path.exists(directory_path):
 
-        logging.info("Input dataset does not exist.")
-        logging.info("Downloading")
+        logger.info("Input dataset does not exist.")
+        logger.info("Downloading")
 
         os.makedirs(directory_path)
 
@@ -135,25 +438,25 @@ def download_and_unzip(url, directory_path):
         
         if response.status_code == 200:
 
-            logging.info("Download complete.")
+            logger.info("Download complete.")
 
             with open(zip_file_path, 'wb') as zip_file:
                 zip_file.write(response.content)
 
-            logging.info("Unzipping dataset.")
+            logger.info("Unzipping dataset.")
 
             # Unzip the file
             with zipfile.ZipFile(zip_file_path, 'r') as zip_ref:
                 zip_ref.extractall(directory_path)
 
-            logging.info("Unzip complete.")
+            logger.info("Unzip complete.")
 
             # Remove the temporary zip file
             os.remove(zip_file_path)
         else:
-            logging.info(f"Failed to download zip from {url}. HTTP Status Code: {response.status_code}")
+            logger.info("Failed to download zip from %s. HTTP Status Code: %s", url, response.status_code)
     else:
-        logging.info(f"The directory {directory_path} already exists.")
+        logger.info("The directory %s already exists.", directory_path)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Process and combine mask images.')
@@ -170,7 +473,7 @@ if __name__ == "__main__":
     setup_logging()
 
     if os.path.exists(args.output_dir):
-        logging.info(f"The output path {args.output_dir} already exists.")
+        logger.info("The output path %s already exists.", args.output_dir)
         exit()
 
     download_and_unzip("https://datasets.simula.no/downloads/cellular-experiments.zip", args.input_path)